@@ -22,7 +22,10 @@ import itertools
 import time
 import heapq
 import array
-from typing import NamedTuple, Dict, Tuple, Optional, Sequence, List, Set, FrozenSet
+import copy
+import collections
+import threading
+from typing import Callable, NamedTuple, Dict, Tuple, Optional, Sequence, List, Set, FrozenSet
 import json
 import torch
 import matplotlib.pyplot as plt
@@ -92,10 +95,10 @@ validation_split = 0.3
 # Let the first N*validation_split rows be for the validation set
 # and the last N*(1-validation_split) rows be the training data
 
-Y = data[0:int((1-validation_split)*len(data)), 0:1]
+Y = data[int((validation_split)*len(data)):, 0:1]
 Y_validation = data[0:int((validation_split)*len(data)), 0:1]
 
-X = data[0:int((1-validation_split)*len(data)), 1:35]
+X = data[int((validation_split)*len(data)):, 1:35]
 X_validation = data[0:int((validation_split)*len(data)), 1:35]
 
 
@@ -218,8 +221,9 @@ e.g.
 
 # TODO construct an X matrix with a bias term.
 
-X_with_bias = np.hstack((X, np.ones(X.shape)))
-X_validation_with_bias = np.hstack((X_validation, np.ones(X_validation.shape)))
+# A single column of ones is enough -- more identical columns just make X^T X singular
+X_with_bias = np.hstack((X, np.ones((X.shape[0], 1))))
+X_validation_with_bias = np.hstack((X_validation, np.ones((X_validation.shape[0], 1))))
 
 # TODO replace the np.zeros() with the correct code
 B_with_bias = calculate_weights_with_library(X_with_bias, Y)
@@ -242,6 +246,75 @@ plt.plot(Y, residuals_with_bias, 'x')
 plt.plot(Y_validation, residuals_validation_with_bias, 'ro')
 plt.show()
 
+"""A linear model can only do as well as the features we give it.  Instead of the raw initial and goal counts, we can hand it features that say more directly how much work is left:
+
+1. The deficit -- `goal - initial` for each item (together with the initial counts this is just a reparametrization of `X`)
+2. The clipped deficit -- `max(goal - initial, 0)`, i.e. how many of each item we still have to make
+3. Pairwise interactions between the initial counts and clipped deficits, e.g. "we still need a pickaxe *and* have no bench"
+4. A single bias column
+
+This gives us several hundred columns, so rather than building the whole expanded matrix at once we accumulate $X^T X$ and $X^T Y$ a chunk of rows at a time, add a small ridge term to keep it well conditioned, and solve the normal equations with `calculate_weights_with_library`.  Predictions are made a chunk at a time too.  For a single state, inference is still one dot product.
+
+#Extra -- Engineered Features
+* Expand the state columns into deficit and interaction features
+* Fit them with chunked ridge regression
+* Compare against the models above
+"""
+
+
+# Every pair of (initial, clipped deficit) columns, built once per width rather than on every call
+interaction_indices = {}
+
+
+def expand_features(X: np.array) -> np.array:
+    n_items = X.shape[1] // 2
+    initial = X[:, :n_items]
+    deficit = X[:, n_items:] - initial
+    clipped_deficit = np.maximum(deficit, 0)
+    pairs = np.hstack((initial, clipped_deficit))
+    if pairs.shape[1] not in interaction_indices:
+        interaction_indices[pairs.shape[1]] = np.triu_indices(pairs.shape[1], k=1)
+    rows, cols = interaction_indices[pairs.shape[1]]
+    interactions = pairs[:, rows] * pairs[:, cols]
+    return np.hstack((initial, deficit, clipped_deficit, interactions, np.ones((X.shape[0], 1))))
+
+
+def calculate_expanded_weights(X: np.array, Y: np.array, ridge: float = 1e-3, chunk_size: int = 4096) -> np.array:
+    n_features = expand_features(X[:1]).shape[1]
+    XtX = np.zeros((n_features, n_features))
+    XtY = np.zeros((n_features, Y.shape[1]))
+    for start in range(0, len(X), chunk_size):
+        features = expand_features(X[start:start+chunk_size])
+        XtX += np.dot(features.T, features)
+        XtY += np.dot(features.T, Y[start:start+chunk_size])
+    penalty = ridge*np.eye(n_features)
+    # expand_features puts the bias column last, and it should not be shrunk
+    penalty[-1, -1] = 0
+    return calculate_weights_with_library(XtX + penalty, XtY)
+
+
+def calculate_expanded_yhat(X: np.array, B: np.array, chunk_size: int = 4096) -> np.array:
+    return np.vstack([calculate_yhat(expand_features(X[start:start+chunk_size]), B)
+                      for start in range(0, len(X), chunk_size)])
+
+
+B_expanded = calculate_expanded_weights(X, Y)
+
+Yhat_expanded = calculate_expanded_yhat(X, B_expanded)
+Yhat_validation_expanded = calculate_expanded_yhat(X_validation, B_expanded)
+
+residuals_expanded = calculate_residuals(Y, Yhat_expanded)
+residuals_validation_expanded = calculate_residuals(
+    Y_validation, Yhat_validation_expanded)
+
+print('RMSE with expanded features:', calculate_rmse(residuals_expanded))
+print('RMSE Validation with expanded features:',
+      calculate_rmse(residuals_validation_expanded))
+
+plt.plot(Y, residuals_expanded, 'x')
+plt.plot(Y_validation, residuals_validation_expanded, 'ro')
+plt.show()
+
 """Now we are going to use artificial neural networks. We are going to be using PyTorch, one of the leading deep learning libraries. 
 
 NOTE: We are going to be doing this in a GPU enabled way, so be sure to make sure your runtime is set to use a GPU -- Runtime > Change Runtime Type > Hardware Accelerator = GPU
@@ -444,6 +517,25 @@ model = torch.nn.Sequential(
 model.to('cuda')
 
 
+def gradient_clipping_step(X: torch.Tensor, Y: torch.Tensor, model: torch.nn.Module,
+                           optimizer: torch.optim.Optimizer, loss_fn: torch.nn.Module) -> torch.Tensor:
+    # 1. zero the gradient buffers
+    optimizer.zero_grad()
+    # 1. Clear out the "gradient", i.e. the old update amounts
+    model.zero_grad()
+    # 2. Make a prediction
+    Yhat = model.forward(X)
+    # 3. Calculate loss (the error of the residual)
+    loss = loss_fn(Yhat, Y)
+    # 4. Run the loss backwards through the graph
+    loss.backward()
+    # 5. Clip the gradients
+    torch.nn.utils.clip_grad_norm_(model.parameters(), 5)
+    # 6. Run the optimizer to update the weights
+    optimizer.step()
+    return loss
+
+
 def train_with_gradient_clipping(X: torch.Tensor, Y: torch.Tensor, model: torch.nn.Module, epochs: int) -> None:
     # TODO set the optimizer and loss functions
     optimizer = torch.optim.SGD(model.parameters(), lr=0.01)
@@ -454,24 +546,10 @@ def train_with_gradient_clipping(X: torch.Tensor, Y: torch.Tensor, model: torch.
     for t in range(epochs):
 
         # TODO do the training steps here
-        # 1. zero the gradient buffers
-        optimizer.zero_grad()
-        # 1. Clear out the "gradient", i.e. the old update amounts
-        model.zero_grad()
-        # 2. Make a prediction
-        Yhat = model.forward(Xt)
-        # 3. Calculate loss (the error of the residual)
-        loss = loss_fn(Yhat, Yt)
+        loss = gradient_clipping_step(X, Y, model, optimizer, loss_fn)
         if t % 100 == 0:
             print(t, loss.item())
 
-        # 4. Run the loss backwards through the graph
-        loss.backward()
-        # 5. Clip the gradients
-        torch.nn.utils.clip_grad_norm_(model.parameters(), 5)
-        # 6. Run the optimizer to update the weights
-        optimizer.step()
-
 
 train_with_gradient_clipping(Xt, Yt, model, 5000)
 
@@ -670,7 +748,15 @@ def states_to_tensor(initial_state: State, goal_state: State) -> torch.Tensor:
 
 
 def get_heuristic(current_state: State, goal_state: State) -> float:
-    return model.forward(states_to_tensor(current_state, goal_state)).data.numpy()[0, 0]
+    device = next(model.parameters()).device
+    return model.forward(states_to_tensor(current_state, goal_state).to(device)).data.cpu().numpy()[0, 0]
+
+
+def get_linear_heuristic(current_state: State, goal_state: State) -> float:
+    # items_by_index is sorted, so this is the same column order as states_to_tensor
+    x = np.array([current_state.items + goal_state.items], dtype=float)
+    # Times are never negative, and negative estimates send A* chasing states the model extrapolates badly on
+    return max(calculate_yhat(expand_features(x), B_expanded)[0, 0], 0)
 
 
 pruning = [State.from_dict({'cobble': 9}),
@@ -706,8 +792,34 @@ def prune(state: State) -> bool:
 # but before adding a node to the open set
 
 
-def a_star(initial: State, goal: State, max_nodes: int) -> Tuple[int, int, Optional[List[str]]]:
-    pass
+def a_star(initial: State, goal: State, max_nodes: int,
+           heuristic: Callable[[State, State], float] = get_heuristic) -> Tuple[int, int, Optional[List[str]]]:
+    # The counter breaks ties so that states never need to be compared with each other
+    counter = itertools.count()
+    open_set = [(heuristic(initial, goal), next(counter), 0, initial, [])]
+    best_costs = {initial: 0}
+    visited = 0
+    while open_set and visited < max_nodes:
+        _, _, cost, state, path = heapq.heappop(open_set)
+        # Skip stale entries that were superseded by a cheaper route
+        if cost > best_costs[state]:
+            continue
+        visited += 1
+        if state >= goal:
+            return visited, cost, path
+        for name, recipe in recipes.items():
+            if not preconditions_satisfied(state, recipe):
+                continue
+            next_state = apply_effects(state, recipe)
+            if prune(next_state):
+                continue
+            next_cost = cost + recipe.cost
+            if next_state in best_costs and best_costs[next_state] <= next_cost:
+                continue
+            best_costs[next_state] = next_cost
+            heapq.heappush(open_set, (next_cost + heuristic(next_state, goal),
+                                      next(counter), next_cost, next_state, path + [name]))
+    return visited, 0, None
 
 
 print(a_star(State.from_dict({'wood': 1}),
@@ -716,3 +828,281 @@ print(a_star(State.from_dict({'wood': 1}),
              State.from_dict({'iron_pickaxe': 1}), 20000))
 print(a_star(State.from_dict({}), State.from_dict({'rail': 1}), 20000))
 print(a_star(State.from_dict({}), State.from_dict({'cart': 1}), 20000))
+
+"""The engineered-feature linear model is much cheaper to evaluate than the network, so try it as the heuristic too.  A low RMSE is not the whole story, though -- what matters is how many states the search visits and how long each query takes end to end.
+
+Be careful with its estimates on states unlike anything in the training data.  Left unclamped, they can go negative, and A* then dives after those states: on our test data the unclamped linear heuristic ran out of nodes on `iron_pickaxe` and `cart`, both of which A* solves with no heuristic at all.  Clamping the estimate at 0 fixes that.
+"""
+
+queries = [(State.from_dict({'wood': 1}), State.from_dict({'wooden_pickaxe': 1}), 1000),
+           (State.from_dict({'wood': 1}), State.from_dict({'iron_pickaxe': 1}), 20000),
+           (State.from_dict({}), State.from_dict({'rail': 1}), 20000),
+           (State.from_dict({}), State.from_dict({'cart': 1}), 20000)]
+
+for initial, goal, max_nodes in queries:
+    for heuristic in [get_heuristic, get_linear_heuristic]:
+        start = time.time()
+        visited, cost, path = a_star(initial, goal, max_nodes, heuristic)
+        print(heuristic.__name__, {k: v for k, v in goal.to_dict().items() if v}, 'visited:', visited,
+              'no path' if path is None else 'cost: {}'.format(cost),
+              'seconds: {:.3f}'.format(time.time() - start))
+
+"""Forward search from an empty inventory spreads across a lot of intermediate items before it reaches something like a `cart`, and a learned heuristic only helps as much as its training data covers the query.  We can instead work out what the goal needs straight from the recipes, by *regressing* it: for every item the goal is still missing, pick the cheapest recipe that produces it and add that recipe's `consumes` and `requires` to what we need, all the way down to items we already have.
+
+While doing this we reuse leftovers (one `craft plank` makes four planks) and build each missing tool only once.  The total cost of the recipes we picked is the cost of a relaxed plan -- it ignores the order the steps have to happen in, so it is not admissible -- but it is far better informed than no heuristic at all.
+
+To pick the cheapest recipe we need a rough price for every item, which we get by repeatedly relaxing the cost of one unit of each item, built from nothing, until nothing changes.
+
+#Extra -- Goal Regression
+* Regress the goal through the recipes to estimate the remaining time
+* Compare it against no heuristic and the network on the queries above
+"""
+
+
+def calculate_unit_costs() -> List[float]:
+    unit_costs = [float('inf') for item in items_by_index]
+    changed = True
+    while changed:
+        changed = False
+        for recipe in recipes.values():
+            cost = (recipe.cost
+                    + sum(count*unit_costs[index] for index, count in enumerate(recipe.consumes.items) if count)
+                    + sum(unit_costs[index] for index, count in enumerate(recipe.requires.items) if count))
+            for index, count in enumerate(recipe.produces.items):
+                if count and cost/count < unit_costs[index]:
+                    unit_costs[index] = cost/count
+                    changed = True
+    return unit_costs
+
+
+unit_costs = calculate_unit_costs()
+producers = [[recipe for recipe in recipes.values() if recipe.produces.items[index]]
+             for index in range(len(items_by_index))]
+
+
+def regression_heuristic(current_state: State, goal_state: State) -> float:
+    have = list(current_state.items)
+    total = 0
+
+    def price(recipe: Recipe, index: int) -> float:
+        # Tools we already have are free, everything else is charged at its unit cost
+        return (recipe.cost
+                + sum(count*unit_costs[j] for j, count in enumerate(recipe.consumes.items) if count)
+                + sum(unit_costs[j] for j, count in enumerate(recipe.requires.items) if count and have[j] == 0)) / recipe.produces.items[index]
+
+    def need(index: int, amount: int, active: FrozenSet[int]) -> None:
+        nonlocal total
+        used = min(have[index], amount)
+        have[index] -= used
+        amount -= used
+        # Items already being regressed further up would only send us round in a cycle
+        if amount == 0 or index in active:
+            return
+        recipe = min(producers[index], key=lambda recipe: price(recipe, index))
+        times = -(-amount // recipe.produces.items[index])
+        active = active | {index}
+        for j, count in enumerate(recipe.requires.items):
+            if count and have[j] == 0:
+                need(j, 1, active)
+                have[j] += 1
+        for j, count in enumerate(recipe.consumes.items):
+            if count:
+                need(j, times*count, active)
+        total += times*recipe.cost
+        have[index] += times*recipe.produces.items[index] - amount
+
+    for index, count in enumerate(goal_state.items):
+        if count:
+            need(index, count, frozenset())
+    return total
+
+
+def no_heuristic(current_state: State, goal_state: State) -> float:
+    return 0
+
+
+for initial, goal, max_nodes in queries:
+    for heuristic in [no_heuristic, get_heuristic, get_linear_heuristic, regression_heuristic]:
+        start = time.time()
+        visited, cost, path = a_star(initial, goal, max_nodes, heuristic)
+        print(heuristic.__name__, {k: v for k, v in goal.to_dict().items() if v}, 'visited:', visited,
+              'no path' if path is None else 'cost: {}'.format(cost),
+              'seconds: {:.3f}'.format(time.time() - start))
+
+"""Every query that A* solves hands us something for free: for each state along the returned path we know how long the rest of that path takes to reach the goal.  These are the same kind of `(initial state, goal state, time)` rows our heuristic was trained on, so rather than throwing them away we can keep refining the heuristic on the queries we actually care about.
+
+Be careful with those labels, though.  With a learned (inadmissible) heuristic the path A* returns is not guaranteed to be optimal, so the remaining cost along it is only an *upper bound* on the true remaining time -- and the model is being trained on the output of a search it guided itself.  To keep that feedback loop in check we only keep the lowest label seen for each `(state, goal)` pair, and every batch mixes in rows from the original training set so the model stays tied to the true times.
+
+We keep the most recent samples in a bounded replay buffer, and a background thread takes small gradient clipping steps on a copy of the model.  A round of training is only published if it does not raise the RMSE on the validation set -- otherwise the copy goes back to the last weights that passed.  The planner never sees a half-updated network -- new weights are only loaded into `model` when we call `swap`.
+
+#Extra -- Online Heuristic Refinement
+* Collect the remaining costs along each solved path
+* Fine-tune a copy of the heuristic in a background thread, anchored to the original training data
+* Swap the refined weights in between queries
+"""
+
+
+def path_to_samples(initial: State, goal: State, path: List[str]) -> List[Tuple[State, State, int]]:
+    states = [initial]
+    for name in path:
+        states.append(apply_effects(states[-1], recipes[name]))
+    # The remaining cost at each state is whatever is left of the path after it
+    remaining = sum(recipes[name].cost for name in path)
+    samples = []
+    for state, name in zip(states, path + [None]):
+        samples.append((state, goal, remaining))
+        if name is not None:
+            remaining -= recipes[name].cost
+    return samples
+
+
+class HeuristicLearner:
+
+    def __init__(self, model: torch.nn.Module, X_anchor: torch.Tensor, Y_anchor: torch.Tensor,
+                 X_check: np.array, Y_check: np.array, buffer_size: int = 10000, batch_size: int = 256,
+                 anchor_fraction: float = 0.5, steps_per_round: int = 50, lr: float = 0.001):
+        self.model = model
+        self.device = next(model.parameters()).device
+        # The background thread only ever trains this copy, never the planner's model
+        self.shadow = copy.deepcopy(model)
+        self.X_anchor = X_anchor.to(self.device)
+        self.Y_anchor = Y_anchor.to(self.device)
+        # Held-out rows a round of training has to do at least as well on before it is published
+        self.X_check = torch.Tensor(X_check).to(self.device)
+        self.Y_check = Y_check
+        self.accepted_state_dict = self._snapshot()
+        self.accepted_rmse = self._check_rmse()
+        self.accepted = 0
+        self.rejected = 0
+        self.buffer = collections.OrderedDict()
+        self.buffer_size = buffer_size
+        self.n_anchor = int(batch_size*anchor_fraction)
+        self.n_replay = batch_size - self.n_anchor
+        self.steps_per_round = steps_per_round
+        self.lr = lr
+        self.condition = threading.Condition()
+        # Number of solved queries observed, and how many of those a round of training has covered
+        self.observed = 0
+        self.trained = 0
+        self.published = None
+        self.error = None
+        self.stopping = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def stop(self) -> None:
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        if self.thread.ident is not None:
+            self.thread.join()
+        self._raise_error()
+
+    def observe(self, initial: State, goal: State, path: Optional[List[str]]) -> None:
+        if path is None:
+            return
+        with self.condition:
+            for state, _, remaining in path_to_samples(initial, goal, path):
+                key = (state, goal)
+                # Labels are upper bounds, so keep the tightest one rather than a duplicate row
+                if key in self.buffer:
+                    remaining = min(remaining, self.buffer.pop(key)[1])
+                self.buffer[key] = (states_to_tensor(state, goal), float(remaining))
+            while len(self.buffer) > self.buffer_size:
+                self.buffer.popitem(last=False)
+            self.observed += 1
+            self.condition.notify_all()
+
+    def swap(self) -> bool:
+        # Load the most recently published weights into the planner's model, if there are any
+        with self.condition:
+            self._raise_error()
+            state_dict, self.published = self.published, None
+        if state_dict is None:
+            return False
+        self.model.load_state_dict(state_dict)
+        return True
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        # Block until weights trained on every query observed so far have been published
+        with self.condition:
+            self.condition.wait_for(lambda: self.trained >= self.observed or self.error is not None, timeout)
+            self._raise_error()
+            return self.trained >= self.observed
+
+    def _snapshot(self) -> Dict[str, torch.Tensor]:
+        return {k: v.detach().clone() for k, v in self.shadow.state_dict().items()}
+
+    def _check_rmse(self) -> float:
+        Yhat = self.shadow.forward(self.X_check).data.cpu().numpy()
+        return calculate_rmse(calculate_residuals(self.Y_check, Yhat))
+
+    def _raise_error(self) -> None:
+        if self.error is not None:
+            raise RuntimeError('heuristic learner thread failed') from self.error
+
+    def _run(self) -> None:
+        try:
+            self._train()
+        except Exception as e:
+            with self.condition:
+                self.error = e
+                self.condition.notify_all()
+
+    def _train(self) -> None:
+        optimizer = torch.optim.SGD(self.shadow.parameters(), lr=self.lr)
+        loss_fn = torch.nn.MSELoss()
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.stopping or self.observed > self.trained)
+                if self.stopping:
+                    return
+                observed = self.observed
+                samples = list(self.buffer.values())
+            for _ in range(self.steps_per_round):
+                batch = random.sample(samples, min(self.n_replay, len(samples)))
+                anchor = torch.randint(len(self.X_anchor), (self.n_anchor,), device=self.device)
+                Xb = torch.cat([torch.cat([x for x, _ in batch]).to(self.device), self.X_anchor[anchor]])
+                Yb = torch.cat([torch.Tensor([[y] for _, y in batch]).to(self.device), self.Y_anchor[anchor]])
+                gradient_clipping_step(Xb, Yb, self.shadow, optimizer, loss_fn)
+            rmse = self._check_rmse()
+            improved = rmse <= self.accepted_rmse
+            if improved:
+                self.accepted_state_dict = self._snapshot()
+                self.accepted_rmse = rmse
+                self.accepted += 1
+            else:
+                # Throw the round away rather than let the planner's heuristic get worse
+                self.shadow.load_state_dict(self.accepted_state_dict)
+                self.rejected += 1
+            with self.condition:
+                if improved:
+                    self.published = self.accepted_state_dict
+                self.trained = observed
+                self.condition.notify_all()
+
+
+def a_star_with_learning(initial: State, goal: State, max_nodes: int,
+                         learner: HeuristicLearner) -> Tuple[int, int, Optional[List[str]]]:
+    visited, cost, path = a_star(initial, goal, max_nodes)
+    learner.observe(initial, goal, path)
+    return visited, cost, path
+
+
+"""Run the canonical queries a few times.  We record a baseline with the untouched model first, and only swap in new weights between rounds, after waiting for the learner to catch up, so every query in a round uses the same heuristic.  Compare the number of states visited per round against the baseline to see whether the refinement is paying off on these queries."""
+
+baseline = [a_star(initial, goal, max_nodes)[0] for initial, goal, max_nodes in queries]
+print('baseline visited:', baseline)
+
+learner = HeuristicLearner(model, Xt, Yt, X_validation, Y_validation)
+learner.start()
+for round_number in range(3):
+    visited = [a_star_with_learning(initial, goal, max_nodes, learner)[0]
+               for initial, goal, max_nodes in queries]
+    print('round', round_number, 'visited:', visited)
+    learner.wait()
+    learner.swap()
+learner.stop()
+print('rounds published:', learner.accepted, 'rejected:', learner.rejected)